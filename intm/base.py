@@ -1,11 +1,27 @@
 """Base classes"""
 
-from typing import Optional
-from humps.camel import case
+from typing import Any, Optional, Type, TypeVar
 
 from pydantic import BaseModel, Extra
 
 
+RootModelT = TypeVar("RootModelT", bound="RootModel")
+
+
+def to_camel_case(snake: str) -> str:
+    """
+    Converts a snake case name to camel case
+
+    Args:
+        snake: Snake case name
+
+    Returns:
+        str: Camel case name
+    """
+    first, *rest = snake.split("_")
+    return first + "".join(part[:1].upper() + part[1:] for part in rest)
+
+
 class RootModel(BaseModel):
     """Root Graph QL Class"""
 
@@ -14,7 +30,21 @@ class RootModel(BaseModel):
     class Config:
         """Pydantic Config for GraphQlBase"""
 
-        alias_generator = case
+        alias_generator = to_camel_case
         allow_population_by_field_name = True
         populate_by_name = True
         extra = Extra.forbid
+
+    @classmethod
+    def construct_trusted(cls: Type[RootModelT], **values: Any) -> RootModelT:
+        """
+        Creates a model from trusted values without running validation
+
+        Args:
+            **values: Field values by field name
+
+        Returns:
+            RootModelT: Model instance
+        """
+        # model_construct is the pydantic 2 name of construct
+        return getattr(cls, "model_construct", cls.construct)(**values)
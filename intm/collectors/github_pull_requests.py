@@ -1,14 +1,28 @@
 """Collects pull requests from github"""
 
-from threading import Thread
-from typing import List, Dict, Set, Tuple, Optional, Callable, Union
-import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import groupby
+from operator import itemgetter
+from threading import Event, Thread
+from typing import (
+    List,
+    Dict,
+    Iterable,
+    Sequence,
+    Set,
+    Tuple,
+    Optional,
+    Callable,
+    Union,
+)
 import re
+import sys
 
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 
 
 from pydantic import Field
+from sortedcontainers import SortedSet
 
 
 from gitaudit.github.instance import Github
@@ -18,13 +32,27 @@ from gitaudit.github.graphql_objects import (
     CheckRun,
     StatusContext,
 )
-import validators
 
 from intm.base import RootModel
+from intm.rate_limit import TokenBucket
 
 
 PR_QUERY_DATA = """title"""
 
+# Maximum number of pull requests requested by a single update call
+_PAGE_SIZE = 50
+
+# Depends-On line with a pull request url, capturing owner, name and number
+_DEPENDS_ON_RE = re.compile(
+    r"^Depends-On:[ \t]*https?://[^/\s]+/([^/\s]+)/([^/\s]+)/pull/(\d+)(?!\S)",
+    re.MULTILINE,
+)
+_DIGITS_RE = re.compile(r"\d+")
+_SEARCH_TERM_RE = re.compile(r'(?:[^\s"]+|"[^"]*"?)+')
+_PULL_REQUEST_URL_CAPTURE_RE = re.compile(
+    r"(?:.*/)?([^/]*)/([^/]*)/pull/(\d+)", re.DOTALL
+)
+
 
 class RequiredStatusCheck(RootModel):
     """Required status check"""
@@ -37,7 +65,7 @@ class PullRequestContainer(RootModel):
 
     pull_request: PullRequest
     updated_at: datetime
-    dependencies: List[str] = Field(default_factory=list)
+    dependencies: Tuple[str, ...] = ()
     required_status_checks: List[
         Union[RequiredStatusCheck, CheckRun, StatusContext]
     ] = Field(default_factory=list)
@@ -53,14 +81,73 @@ class PullRequestContainer(RootModel):
         return self.pull_request.state == PullRequestState.OPEN
 
 
+class PullRequestsMap(Dict[str, PullRequestContainer]):
+    """Pull request containers by uri, keeping the set of their ids up to date"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.ids: Set[str] = {
+            pr_container.pull_request.id for pr_container in self.values()
+        }
+
+    def __setitem__(self, key: str, value: PullRequestContainer) -> None:
+        previous = self.get(key)
+        if previous is not None:
+            self.ids.discard(previous.pull_request.id)
+
+        super().__setitem__(key, value)
+        self.ids.add(value.pull_request.id)
+
+    def __delitem__(self, key: str) -> None:
+        self.ids.discard(self[key].pull_request.id)
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *args):
+        if key in self:
+            self.ids.discard(self[key].pull_request.id)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.ids.discard(value.pull_request.id)
+        return key, value
+
+    def clear(self) -> None:
+        super().clear()
+        self.ids.clear()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
 DependencyCallback = Callable[[PullRequest], Tuple[List[str], List[str]]]
 NeedUpdateCallback = Callable[[PullRequestContainer], bool]
+# Checks all containers in one pass and returns the ids of those needing an update
+NeedUpdateBatchCallback = Callable[[Iterable[PullRequestContainer]], Iterable[str]]
 RequiredStatusChecksCallback = Callable[[PullRequest], List[str]]
+# Returns the time the rate limit resets at when the budget is low, else None.
+# Naive times are taken as utc.
+RateLimitResetCallback = Callable[[], Optional[datetime]]
+
+# Shared result when there is no dependencies callback, never mutated
+_NO_DEPENDENCIES: Tuple[List[str], List[str]] = ([], [])
 
 
 class CollectQuery:
     """Base class for collect queries"""
 
+    __slots__ = ()
+
     @property
     def query(self):
         """
@@ -75,6 +162,8 @@ class CollectQuery:
 class ConstantCollectQuery(CollectQuery):
     """Query that is constant"""
 
+    __slots__ = ("_query",)
+
     def __init__(self, query):
         self._query = query
 
@@ -84,33 +173,112 @@ class ConstantCollectQuery(CollectQuery):
 
 
 class RecentlyUpdatedPullRequests(CollectQuery):
-    """Query that collects pull requests that were updated recently"""
+    """
+    Query that collects pull requests that were updated recently
 
-    def __init__(self, base_query, time_delta: timedelta):
+    The current time is rounded down to a multiple of quantize since midnight, so
+    the query text only changes every quantize and identical queries can be
+    served from caches. A zero quantize disables the rounding.
+    """
+
+    __slots__ = ("base_query", "time_delta", "quantize")
+
+    def __init__(
+        self,
+        base_query,
+        time_delta: timedelta,
+        quantize: timedelta = timedelta(seconds=30),
+    ):
         self.base_query = base_query
         self.time_delta = time_delta
+        self.quantize = quantize
 
     @property
     def query(self):
-        return f"{self.base_query} updated:>={(datetime.utcnow() - self.time_delta).isoformat()}"
+        now = datetime.utcnow()
+        if self.quantize:
+            midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            now = midnight + (now - midnight) // self.quantize * self.quantize
+        return f"{self.base_query} updated:>={(now - self.time_delta).isoformat()}"
+
+
+def _split_repository_terms(query_text: str) -> Tuple[Tuple[str, ...], List[str]]:
+    terms = _SEARCH_TERM_RE.findall(query_text)
+    return (
+        tuple(term for term in terms if not term.startswith("repo:")),
+        [term for term in terms if term.startswith("repo:")],
+    )
 
 
-def const_queries_from_list(query_texts: List[str]) -> List[ConstantCollectQuery]:
+class MergedConstantCollectQuery(ConstantCollectQuery):
+    """Union of constant queries that only differ in their repo: qualifiers"""
+
+    __slots__ = ()
+
+    def __init__(self, query_texts: List[str]):
+        stem, _ = _split_repository_terms(query_texts[0])
+        repository_terms: List[str] = []
+
+        for query_text in query_texts:
+            query_stem, query_repository_terms = _split_repository_terms(query_text)
+            assert (
+                query_stem == stem
+            ), f"Query {query_text} does not share the stem of {query_texts[0]}"
+            repository_terms.extend(
+                term for term in query_repository_terms if term not in repository_terms
+            )
+
+        super().__init__(" ".join(stem + tuple(repository_terms)))
+
+
+def const_queries_from_list(
+    query_texts: List[str], merge_repositories: bool = False
+) -> Tuple[ConstantCollectQuery, ...]:
     """
-    Creates a list of ConstantCollectQuery from a list of query texts
+    Creates a tuple of ConstantCollectQuery from a list of query texts
+
+    With merge_repositories, queries that only differ in their repo: qualifiers
+    are merged into a single query, as GitHub search unions multiple repo:
+    qualifiers. A search returns at most 1000 results, so a merged query can miss
+    pull requests the separate queries would have found. Queries without a repo:
+    qualifier are kept as they are.
 
     Args:
         query_texts: List of query texts
+        merge_repositories: Merge queries that only differ in their repo: qualifiers
 
     Returns:
-        List[ConstantCollectQuery]: List of ConstantCollectQuery
+        Tuple[ConstantCollectQuery, ...]: Tuple of ConstantCollectQuery
     """
 
-    return [ConstantCollectQuery(q) for q in query_texts]
+    if not merge_repositories:
+        return tuple(ConstantCollectQuery(q) for q in query_texts)
+
+    texts_by_stem: Dict[Union[int, Tuple[str, ...]], List[str]] = {}
+
+    for index, query_text in enumerate(query_texts):
+        stem, repository_terms = _split_repository_terms(query_text)
+        # Queries without repo: qualifiers get a key of their own
+        texts_by_stem.setdefault(stem if repository_terms else index, []).append(
+            query_text
+        )
+
+    return tuple(
+        MergedConstantCollectQuery(texts)
+        if len(texts) > 1
+        else ConstantCollectQuery(texts[0])
+        for texts in texts_by_stem.values()
+    )
 
 
-def _internal_sleep(seconds: int) -> None:
-    time.sleep(seconds)
+def _invalid_pull_request_url_reason(url: str) -> str:
+    split_url = url.split("/")
+
+    if len(split_url) < 4:
+        return "does not have enough parts"
+    if not _DIGITS_RE.fullmatch(split_url[-1]):
+        return "does not end with a number"
+    return "does not end with /pull/<number>"
 
 
 def pull_request_url_to_uri(url: str) -> str:
@@ -120,21 +288,21 @@ def pull_request_url_to_uri(url: str) -> str:
     Args:
         url: Pull request url
 
+    Raises:
+        AssertionError: If the url does not end with <owner>/<name>/pull/<number>
+
     Returns:
         str: Pull request uri
     """
 
-    split_url = url.split("/")
+    match = _PULL_REQUEST_URL_CAPTURE_RE.fullmatch(url)
 
-    assert len(split_url) >= 4, f"Pull request url {url} does not have enough parts"
-    assert re.fullmatch(
-        r"\d+", split_url[-1]
-    ), f"Pull request url {url} does not end with a number"
-    assert (
-        split_url[-2] == "pull"
-    ), f"Pull request url {url} does not end with /pull/<number>"
+    if not match:
+        raise AssertionError(
+            f"Pull request url {url} {_invalid_pull_request_url_reason(url)}"
+        )
 
-    return f"{split_url[-4]}/{split_url[-3]}#{split_url[-1]}"
+    return f"{match[1]}/{match[2]}#{match[3]}"
 
 
 def zuul_dependencies_from_pull_request(
@@ -150,31 +318,62 @@ def zuul_dependencies_from_pull_request(
         Tuple[List[str], List[str]]: Dependencies as two lists, first list of IDs and second list of URIs
     """
 
-    deps = re.findall(r"^Depends-On:\s?(.*?)$", pull_request.body, re.MULTILINE)
+    # Most bodies have no dependencies, a substring check is far cheaper than the regex
+    if "Depends-On:" not in pull_request.body:
+        return [], []
 
-    deps = list(map(lambda x: re.split(r"\s+", x)[0].strip(), deps))
+    return [], [
+        f"{match[1]}/{match[2]}#{match[3]}"
+        for match in _DEPENDS_ON_RE.finditer(pull_request.body)
+    ]
 
-    valid_deps: List[str] = list(filter(validators.url, deps))
 
-    return [], list(map(pull_request_url_to_uri, valid_deps))
+def _uri_sort_key(uri: str) -> Tuple[str, int]:
+    owner_with_name, number = uri.rsplit("#", 1)
+    return owner_with_name, int(number)
 
 
 def open_pull_request_last_update_30_minutes_ago(
     pr_container: PullRequestContainer,
+    now: Optional[datetime] = None,
 ) -> bool:
     """
     Checks if an open pull request was last updated 30 minutes ago
 
     Args:
         pr_container: Pull request container to check
+        now: Reference time, shared when checking many containers. Defaults to utcnow
 
     Returns:
         bool: True if pull request was last updated 30 minutes ago
     """
 
-    return pr_container.is_open and pr_container.updated_at < (
-        datetime.utcnow() - timedelta(minutes=30)
-    )
+    if not pr_container.is_open:
+        return False
+
+    threshold = (now if now else datetime.utcnow()) - timedelta(minutes=30)
+    return pr_container.updated_at < threshold
+
+
+def open_pull_requests_last_update_30_minutes_ago(
+    pr_containers: Iterable[PullRequestContainer],
+) -> List[str]:
+    """
+    Batch variant of open_pull_request_last_update_30_minutes_ago
+
+    Args:
+        pr_containers: Pull request containers to check
+
+    Returns:
+        List[str]: Ids of the open pull requests last updated 30 minutes ago
+    """
+
+    now = datetime.utcnow()
+    return [
+        pr_container.pull_request.id
+        for pr_container in pr_containers
+        if open_pull_request_last_update_30_minutes_ago(pr_container, now)
+    ]
 
 
 class GithubPullRequestCollector(Thread):
@@ -183,12 +382,17 @@ class GithubPullRequestCollector(Thread):
     def __init__(
         self,
         github: Github,
-        queries: Optional[List[CollectQuery]] = None,
+        queries: Optional[Sequence[CollectQuery]] = None,
         update_query: Optional[CollectQuery] = None,
         dependencies_callback: Optional[DependencyCallback] = None,
         need_update_callbacks: Optional[List[NeedUpdateCallback]] = None,
+        need_update_batch_callbacks: Optional[List[NeedUpdateBatchCallback]] = None,
         required_status_checks_callback: Optional[RequiredStatusChecksCallback] = None,
         wait_time: timedelta = timedelta(minutes=5),
+        max_workers: int = 8,
+        search_rate_limit: Optional[TokenBucket] = None,
+        core_rate_limit: Optional[TokenBucket] = None,
+        rate_limit_reset_callback: Optional[RateLimitResetCallback] = None,
     ) -> None:
         super().__init__(target=self._run)
 
@@ -198,85 +402,162 @@ class GithubPullRequestCollector(Thread):
         self.need_update_callbacks = (
             need_update_callbacks if need_update_callbacks else []
         )
+        self.need_update_batch_callbacks = (
+            need_update_batch_callbacks if need_update_batch_callbacks else []
+        )
         self.required_status_checks_callback = required_status_checks_callback
-        self._keep_running: bool = True
+        self.rate_limit_reset_callback = rate_limit_reset_callback
+        self._stop_event = Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Defaults follow GitHub's search (30/min) and core (5000/h) budgets
+        self.search_rate_limit = (
+            search_rate_limit if search_rate_limit else TokenBucket(30 / 60, 10)
+        )
+        self.core_rate_limit = (
+            core_rate_limit if core_rate_limit else TokenBucket(5000 / 3600, 50)
+        )
 
-        self.pull_requests_map: Dict[str, PullRequestContainer] = {}
-        self.queries: List[CollectQuery] = queries if queries else []
+        self._pull_requests_map = PullRequestsMap()
+        self.queries: Sequence[CollectQuery] = queries if queries else ()
         self.update_query: Optional[CollectQuery] = update_query
 
-        self.pull_requests_needing_update_ids: Set[str] = set()
-        self.pull_requests_needing_update_uris: Set[str] = set()
+        self.pull_requests_needing_update_ids: SortedSet = SortedSet()
+        self.pull_requests_needing_update_uris: SortedSet = SortedSet(key=_uri_sort_key)
 
     def _run(self):
-        keep_running = True
+        try:
+            while True:
+                if self._wait_for_rate_limit_reset():
+                    break
 
-        while keep_running:
-            for query in self.queries:
-                self._update_pull_requests(
-                    self.github.search_pull_requests(query.query, PR_QUERY_DATA)
-                )
+                search_queries = [query.query for query in self.queries]
+                if self.update_query:
+                    search_queries.append(self.update_query.query)
 
-            if self.update_query:
-                self._update_pull_requests(
-                    self.github.search_pull_requests(self.update_query, PR_QUERY_DATA)
-                )
+                self._update_from_futures(self._submit_searches(search_queries))
 
-            for pr_container in self.pull_requests_map.values():
-                for callback in self.need_update_callbacks:
-                    if callback(pr_container):
-                        self.pull_requests_needing_update_ids.add(
-                            pr_container.pull_request.id
-                        )
+                for pr_container in self.pull_requests_map.values():
+                    for callback in self.need_update_callbacks:
+                        if callback(pr_container):
+                            self.pull_requests_needing_update_ids.add(
+                                pr_container.pull_request.id
+                            )
 
-            self._need_update_collect()
+                for batch_callback in self.need_update_batch_callbacks:
+                    self.pull_requests_needing_update_ids.update(
+                        batch_callback(self.pull_requests_map.values())
+                    )
 
-            _internal_sleep(self.wait_time.total_seconds())
+                self._need_update_collect()
 
-            # This is done this way to make sure in testing that the thread is run at least once
-            keep_running = self._keep_running
+                # Checked after the first pass so that the thread is run at least once
+                if self._stop_event.wait(self.wait_time.total_seconds()):
+                    break
+        finally:
+            self._executor.shutdown()
 
-    def stop(self) -> None:
-        """Stops the collector"""
-        self._keep_running = False
+    def _wait_for_rate_limit_reset(self) -> bool:
+        # Returns True if the collector was stopped while waiting
+        if not self.rate_limit_reset_callback:
+            return False
 
-    def _need_update_collect(self):
-        # Update PRs based on their id
-        if self.pull_requests_needing_update_ids:
-            update_ids = sorted(list(self.pull_requests_needing_update_ids)[:50])
-            self._update_pull_requests(
-                self.github.get_pull_requests_by_ids(update_ids, PR_QUERY_DATA)
-            )
+        reset_at = self.rate_limit_reset_callback()
 
-        # Update PRs based on their uri
-        pr_uris = list(self.pull_requests_needing_update_uris)
+        if not reset_at:
+            return False
 
-        if pr_uris:
-            owner_with_name = pr_uris[0].split("#")[0]
-            pr_uris_with_correct_owner_with_name = list(
-                filter(lambda x: x.split("#")[0] == owner_with_name, pr_uris)
-            )
-            update_uris = pr_uris_with_correct_owner_with_name[:50]
-            update_numbers = sorted([uri.split("#")[1] for uri in update_uris], key=int)
-            self._update_pull_requests(
-                self.github.search_pull_requests(
-                    f'repo:{owner_with_name} is:pr {" ".join(update_numbers)}',
-                    PR_QUERY_DATA,
-                )
-            )
+        if reset_at.tzinfo is not None:
+            # Aware times, e.g. parsed from GitHub's resetAt, are compared as naive utc
+            reset_at = reset_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return self._stop_event.wait(
+            max(0.0, (reset_at - datetime.utcnow()).total_seconds())
+        )
+
+    @property
+    def pull_requests_map(self) -> PullRequestsMap:
+        """
+        Collected pull requests by uri
+
+        Returns:
+            PullRequestsMap: Collected pull requests by uri
+        """
+        return self._pull_requests_map
+
+    @pull_requests_map.setter
+    def pull_requests_map(self, value: Dict[str, PullRequestContainer]) -> None:
+        self._pull_requests_map = PullRequestsMap(value)
+
+    def stop(self) -> None:
+        """Stops the collector, interrupting a running wait"""
+        self._stop_event.set()
 
-    def _update_pull_requests(self, pull_requests: List[PullRequest]):
-        all_ids = set(
-            map(lambda x: x.pull_request.id, self.pull_requests_map.values())
-        ) | set(map(lambda x: x.id, pull_requests))
+    def _need_update_collect(self):
+        # Update PRs based on their id, one request per page
+        update_ids = list(self.pull_requests_needing_update_ids)
+        futures: List[Future] = [
+            self._executor.submit(
+                self._get_pull_requests_by_ids, update_ids[index : index + _PAGE_SIZE]
+            )
+            for index in range(0, len(update_ids), _PAGE_SIZE)
+        ]
+
+        # Update PRs based on their uri, one search per repository and page.
+        # The uris are sorted by repository and number, so groups are contiguous.
+        search_queries = []
+        uri_keys = map(_uri_sort_key, self.pull_requests_needing_update_uris)
+        for owner_with_name, keys in groupby(uri_keys, key=itemgetter(0)):
+            numbers = [str(number) for _, number in keys]
+            for index in range(0, len(numbers), _PAGE_SIZE):
+                page_numbers = " ".join(numbers[index : index + _PAGE_SIZE])
+                search_queries.append(f"repo:{owner_with_name} is:pr {page_numbers}")
+
+        futures.extend(self._submit_searches(search_queries))
+
+        self._update_from_futures(futures)
+
+    def _search_pull_requests(self, search_query: str) -> List[PullRequest]:
+        if not self.search_rate_limit.acquire(self._stop_event):
+            return []
+        return self.github.search_pull_requests(search_query, PR_QUERY_DATA)
+
+    def _get_pull_requests_by_ids(self, ids: List[str]) -> List[PullRequest]:
+        if not self.core_rate_limit.acquire(self._stop_event):
+            return []
+        return self.github.get_pull_requests_by_ids(ids, PR_QUERY_DATA)
+
+    def _submit_searches(self, search_queries: List[str]) -> List[Future]:
+        return [
+            self._executor.submit(self._search_pull_requests, search_query)
+            for search_query in search_queries
+        ]
+
+    def _update_from_futures(self, futures: List[Future]) -> None:
+        for future in as_completed(futures):
+            pull_requests = future.result()
+            if pull_requests:
+                self._update_pull_requests(pull_requests)
+
+    def _update_pull_requests(self, pull_requests: Iterable[PullRequest]):
+        # Consumed lazily, ids of pull requests later in the batch that were
+        # queued as dependencies are discarded again once they are processed
+        now = datetime.utcnow()
 
         for pull_request in pull_requests:
+            # Interned so the key is shared with dependency lists referencing it
+            uri = sys.intern(pull_request.uri)
+
             dep_ids, dep_uris = (
                 self.dependencies_callback(pull_request)
                 if self.dependencies_callback
-                else ([], [])
+                else _NO_DEPENDENCIES
             )
 
+            if dep_ids or dep_uris:
+                dependencies = tuple(sys.intern(dep) for dep in dep_ids + dep_uris)
+            else:
+                dependencies = ()
+
             if self.required_status_checks_callback:
                 required_status_check_names = self.required_status_checks_callback(
                     pull_request
@@ -300,19 +581,20 @@ class GithubPullRequestCollector(Thread):
                                 status_check.context
                             ] = status_check
 
-            self.pull_requests_map[pull_request.uri] = PullRequestContainer(
+            pr_container = PullRequestContainer.construct_trusted(
                 pull_request=pull_request,
-                updated_at=datetime.utcnow(),
-                dependencies=dep_ids + dep_uris,
+                updated_at=now,
+                dependencies=dependencies,
                 required_status_checks=list(required_status_checks_map.values()),
             )
+            self._pull_requests_map[uri] = pr_container
 
-            self.pull_requests_needing_update_ids.update(
-                filter(lambda x: x not in all_ids, dep_ids)
+            self.pull_requests_needing_update_ids |= set(dep_ids).difference(
+                self._pull_requests_map.ids
             )
-            self.pull_requests_needing_update_uris.update(
-                filter(lambda x: x not in self.pull_requests_map, dep_uris)
+            self.pull_requests_needing_update_uris |= set(dep_uris).difference(
+                self._pull_requests_map
             )
 
             self.pull_requests_needing_update_ids.discard(pull_request.id)
-            self.pull_requests_needing_update_uris.discard(pull_request.uri)
+            self.pull_requests_needing_update_uris.discard(uri)
@@ -0,0 +1,47 @@
+"""Rate limiting"""
+
+from threading import Event, Lock
+from typing import Optional
+import time
+
+
+class TokenBucket:
+    """Token bucket holding up to burst tokens, refilled by rate tokens per second"""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.burst), self._tokens + (now - self._refilled_at) * self.rate
+        )
+        self._refilled_at = now
+
+    def acquire(self, stop_event: Optional[Event] = None) -> bool:
+        """
+        Takes a token, blocking until one is available
+
+        Args:
+            stop_event: Event interrupting the wait for a token once set
+
+        Returns:
+            bool: True if a token was taken, False if the wait was interrupted
+        """
+        with self._lock:
+            self._refill()
+
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                if stop_event is None:
+                    time.sleep(delay)
+                elif stop_event.wait(delay):
+                    return False
+                self._refill()
+
+            self._tokens -= 1
+            return True
@@ -0,0 +1,39 @@
+from unittest import TestCase
+from typing import List
+
+from intm.base import RootModel, to_camel_case
+
+
+class Model(RootModel):
+    some_value: int
+    other_values: List[str] = []
+
+
+class TestToCamelCase(TestCase):
+    def test_single_word(self):
+        self.assertEqual(to_camel_case("typename"), "typename")
+
+    def test_multiple_words(self):
+        self.assertEqual(
+            to_camel_case("required_status_checks"), "requiredStatusChecks"
+        )
+
+    def test_keeps_case_of_remaining_letters(self):
+        self.assertEqual(to_camel_case("pull_request_URL"), "pullRequestURL")
+
+
+class TestRootModel(TestCase):
+    def test_construct_trusted(self):
+        model = Model.construct_trusted(some_value=3)
+
+        self.assertEqual(model.some_value, 3)
+        self.assertEqual(model.other_values, [])
+        self.assertIsNone(model.typename)
+
+    def test_construct_trusted_skips_validation(self):
+        model = Model.construct_trusted(some_value="not a number")
+
+        self.assertEqual(model.some_value, "not a number")
+
+    def test_alias(self):
+        self.assertEqual(Model(someValue=3).some_value, 3)
@@ -0,0 +1,42 @@
+from collections import deque
+from typing import List, Optional, Tuple
+
+from gitaudit.github.graphql_objects import PullRequest
+
+
+class StubGithub:
+    """
+    Stand-in for gitaudit's Github client
+
+    Each call returns the next queued response, or an empty list once all queued
+    responses are used up, and is recorded as an (arguments, querydata) tuple.
+    """
+
+    def __init__(
+        self,
+        search_pull_requests: Optional[List[List[PullRequest]]] = None,
+        get_pull_requests_by_ids: Optional[List[List[PullRequest]]] = None,
+    ) -> None:
+        self._search_pull_requests_responses = deque(search_pull_requests or [])
+        self._get_pull_requests_by_ids_responses = deque(
+            get_pull_requests_by_ids or []
+        )
+
+        self.search_pull_requests_calls: List[Tuple[str, str]] = []
+        self.get_pull_requests_by_ids_calls: List[Tuple[List[str], str]] = []
+
+    def search_pull_requests(self, search_query: str, querydata: str):
+        self.search_pull_requests_calls.append((search_query, querydata))
+        return (
+            self._search_pull_requests_responses.popleft()
+            if self._search_pull_requests_responses
+            else []
+        )
+
+    def get_pull_requests_by_ids(self, ids: List[str], querydata: str):
+        self.get_pull_requests_by_ids_calls.append((ids, querydata))
+        return (
+            self._get_pull_requests_by_ids_responses.popleft()
+            if self._get_pull_requests_by_ids_responses
+            else []
+        )
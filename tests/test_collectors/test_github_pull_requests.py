@@ -1,6 +1,8 @@
 from unittest import TestCase
-from unittest.mock import patch, Mock, call
-from datetime import datetime, timedelta
+from unittest.mock import patch, Mock
+from threading import Event
+from datetime import datetime, timedelta, timezone
+import sys
 import time
 
 from gitaudit.github.instance import Github
@@ -12,18 +14,22 @@ from gitaudit.github.graphql_objects import (
     StatusContext,
 )
 
+from intm.rate_limit import TokenBucket
+from tests.test_collectors.mock_github import StubGithub
 from intm.collectors.github_pull_requests import (
     CollectQuery,
     ConstantCollectQuery,
+    MergedConstantCollectQuery,
     RecentlyUpdatedPullRequests,
     const_queries_from_list,
-    _internal_sleep,
     GithubPullRequestCollector,
     PR_QUERY_DATA,
     pull_request_url_to_uri,
     zuul_dependencies_from_pull_request,
     PullRequestContainer,
+    PullRequestsMap,
     open_pull_request_last_update_30_minutes_ago,
+    open_pull_requests_last_update_30_minutes_ago,
     RequiredStatusCheck,
 )
 
@@ -38,8 +44,18 @@ class TestConstantCollectQuery(TestCase):
     def test_query(self):
         self.assertEqual(ConstantCollectQuery("query").query, "query")
 
+    def test_slots(self):
+        self.assertFalse(hasattr(ConstantCollectQuery("query"), "__dict__"))
+
 
 class TestRecentlyUpdatedPullRequests(TestCase):
+    def test_slots(self):
+        self.assertFalse(
+            hasattr(
+                RecentlyUpdatedPullRequests("query", timedelta(minutes=1)), "__dict__"
+            )
+        )
+
     def test_query(self):
         with patch("intm.collectors.github_pull_requests.datetime") as mock_utc_now:
             mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43)
@@ -50,6 +66,44 @@ class TestRecentlyUpdatedPullRequests(TestCase):
                 "query updated:>=2010-10-08T11:42:00",
             )
 
+    def test_query_quantized(self):
+        with patch("intm.collectors.github_pull_requests.datetime") as mock_utc_now:
+            mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43, 29, 123)
+
+            self.assertEqual(
+                RecentlyUpdatedPullRequests("query", timedelta(minutes=1)).query,
+                "query updated:>=2010-10-08T11:42:00",
+            )
+
+            mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43, 31)
+
+            self.assertEqual(
+                RecentlyUpdatedPullRequests("query", timedelta(minutes=1)).query,
+                "query updated:>=2010-10-08T11:42:30",
+            )
+
+    def test_query_custom_quantize(self):
+        with patch("intm.collectors.github_pull_requests.datetime") as mock_utc_now:
+            mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43, 29)
+
+            self.assertEqual(
+                RecentlyUpdatedPullRequests(
+                    "query", timedelta(minutes=1), quantize=timedelta(seconds=1)
+                ).query,
+                "query updated:>=2010-10-08T11:42:29",
+            )
+
+    def test_query_zero_quantize(self):
+        with patch("intm.collectors.github_pull_requests.datetime") as mock_utc_now:
+            mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43, 29, 123)
+
+            self.assertEqual(
+                RecentlyUpdatedPullRequests(
+                    "query", timedelta(minutes=1), quantize=timedelta(0)
+                ).query,
+                "query updated:>=2010-10-08T11:42:29.000123",
+            )
+
 
 class TestConstQueriesFromList(TestCase):
     def test_const_queries_from_list(self):
@@ -58,23 +112,116 @@ class TestConstQueriesFromList(TestCase):
             ["query1", "query2"],
         )
 
+    def test_returns_tuple(self):
+        self.assertIsInstance(const_queries_from_list(["query1", "query2"]), tuple)
+        self.assertIsInstance(
+            const_queries_from_list(["query1"], merge_repositories=True), tuple
+        )
 
-class TestInternalSleep(TestCase):
-    def setUp(self) -> None:
-        super().setUp()
+    def test_merge_repositories(self):
+        self.assertEqual(
+            list(
+                map(
+                    lambda x: x.query,
+                    const_queries_from_list(
+                        [
+                            "is:pr is:open repo:owner/one",
+                            "is:pr org:owner",
+                            "repo:owner/two is:pr is:open",
+                            "is:pr is:open repo:owner/one repo:owner/three",
+                        ],
+                        merge_repositories=True,
+                    ),
+                )
+            ),
+            [
+                "is:pr is:open repo:owner/one repo:owner/two repo:owner/three",
+                "is:pr org:owner",
+            ],
+        )
 
-        self.patch_time_sleep = patch("intm.collectors.github_pull_requests.time.sleep")
-        self.mock_time_sleep = self.patch_time_sleep.start()
+    def test_merge_repositories_quoted_terms(self):
+        self.assertEqual(
+            list(
+                map(
+                    lambda x: x.query,
+                    const_queries_from_list(
+                        [
+                            'is:pr label:"needs review" repo:owner/one',
+                            'is:pr label:"needs review" repo:owner/two',
+                            "is:pr label:needs repo:owner/three",
+                        ],
+                        merge_repositories=True,
+                    ),
+                )
+            ),
+            [
+                'is:pr label:"needs review" repo:owner/one repo:owner/two',
+                "is:pr label:needs repo:owner/three",
+            ],
+        )
 
-    def tearDown(self) -> None:
-        self.patch_time_sleep.stop()
+    def test_do_not_merge_queries_without_repository(self):
+        self.assertEqual(
+            list(
+                map(
+                    lambda x: x.query,
+                    const_queries_from_list(
+                        [
+                            "is:pr repo:owner/one",
+                            "is:pr  is:open",
+                            "is:pr",
+                            "is:pr repo:owner/two",
+                            "is:pr",
+                        ],
+                        merge_repositories=True,
+                    ),
+                )
+            ),
+            [
+                "is:pr repo:owner/one repo:owner/two",
+                "is:pr  is:open",
+                "is:pr",
+                "is:pr",
+            ],
+        )
 
-        super().tearDown()
+    def test_merge_repositories_disabled_by_default(self):
+        self.assertEqual(
+            list(
+                map(
+                    lambda x: x.query,
+                    const_queries_from_list(
+                        ["is:pr repo:owner/one", "is:pr repo:owner/two"],
+                    ),
+                )
+            ),
+            ["is:pr repo:owner/one", "is:pr repo:owner/two"],
+        )
+
+
+class TestMergedConstantCollectQuery(TestCase):
+    def test_slots(self):
+        self.assertFalse(
+            hasattr(MergedConstantCollectQuery(["is:pr repo:owner/one"]), "__dict__")
+        )
+
+    def test_query(self):
+        self.assertEqual(
+            MergedConstantCollectQuery(
+                ["is:pr repo:owner/one", "is:pr repo:owner/two"]
+            ).query,
+            "is:pr repo:owner/one repo:owner/two",
+        )
 
-    def test_internal_sleep(self):
-        _internal_sleep(5)
+    def test_different_stem(self):
+        with self.assertRaises(AssertionError) as ctx:
+            MergedConstantCollectQuery(["is:pr repo:owner/one", "is:issue repo:owner/two"])
 
-        self.mock_time_sleep.assert_called_with(5)
+        self.assertEqual(
+            str(ctx.exception),
+            "Query is:issue repo:owner/two does not share the stem of is:pr repo:owner/one",
+        )
 
 
 class TestPullRequestUrlToUri(TestCase):
@@ -127,6 +274,17 @@ class TestZuulDependenciesFromPullRequest(TestCase):
             ([], []),
         )
 
+    def test_no_dependency_skips_regex(self):
+        with patch(
+            "intm.collectors.github_pull_requests._DEPENDS_ON_RE"
+        ) as mock_depends_on_re:
+            self.assertEqual(
+                zuul_dependencies_from_pull_request(PullRequest(body="Some text")),
+                ([], []),
+            )
+
+        mock_depends_on_re.finditer.assert_not_called()
+
     def test_dependency(self):
         self.assertEqual(
             zuul_dependencies_from_pull_request(
@@ -147,6 +305,36 @@ class TestZuulDependenciesFromPullRequest(TestCase):
             ([], []),
         )
 
+    def test_non_pull_request_dependency(self):
+        self.assertEqual(
+            zuul_dependencies_from_pull_request(
+                PullRequest(
+                    body="Depends-On: https://github.com/MatthiasRieck/int-model/issues/5",
+                ),
+            ),
+            ([], []),
+        )
+
+    def test_enterprise_dependency(self):
+        self.assertEqual(
+            zuul_dependencies_from_pull_request(
+                PullRequest(
+                    body="Depends-On: https://github.example.com/MatthiasRieck/int-model/pull/5",
+                ),
+            ),
+            ([], ["MatthiasRieck/int-model#5"]),
+        )
+
+    def test_dependency_on_next_line(self):
+        self.assertEqual(
+            zuul_dependencies_from_pull_request(
+                PullRequest(
+                    body="Depends-On:\nhttps://github.com/MatthiasRieck/int-model/pull/5",
+                ),
+            ),
+            ([], []),
+        )
+
     def test_formerly_dependency(self):
         self.assertEqual(
             zuul_dependencies_from_pull_request(
@@ -157,6 +345,16 @@ class TestZuulDependenciesFromPullRequest(TestCase):
             ([], []),
         )
 
+    def test_empty_dependency(self):
+        self.assertEqual(
+            zuul_dependencies_from_pull_request(
+                PullRequest(
+                    body="Depends-On: \nDepends-On:",
+                ),
+            ),
+            ([], []),
+        )
+
     def test_multiple_dependencies(self):
         self.assertEqual(
             zuul_dependencies_from_pull_request(
@@ -212,31 +410,147 @@ class TestOpenPullRequestLastUpdate30MinutesAgo(TestCase):
             ),
         )
 
+    def test_reference_time(self):
+        pr_container = PullRequestContainer(
+            pull_request=PullRequest(state="OPEN"),
+            updated_at=datetime(2010, 10, 8, 11, 0),
+        )
 
-class TestGithubPullRequestCollector(TestCase):
-    def setUp(self) -> None:
-        super().setUp()
+        self.assertFalse(
+            open_pull_request_last_update_30_minutes_ago(
+                pr_container, now=datetime(2010, 10, 8, 11, 29)
+            ),
+        )
+        self.assertTrue(
+            open_pull_request_last_update_30_minutes_ago(
+                pr_container, now=datetime(2010, 10, 8, 11, 31)
+            ),
+        )
+
+    def test_batch(self):
+        self.assertListEqual(
+            open_pull_requests_last_update_30_minutes_ago(
+                [
+                    PullRequestContainer(
+                        pull_request=PullRequest(id="id1", state="OPEN"),
+                        updated_at=datetime.utcnow() - timedelta(minutes=31),
+                    ),
+                    PullRequestContainer(
+                        pull_request=PullRequest(id="id2", state="MERGED"),
+                        updated_at=datetime.utcnow() - timedelta(minutes=31),
+                    ),
+                    PullRequestContainer(
+                        pull_request=PullRequest(id="id3", state="OPEN"),
+                        updated_at=datetime.utcnow() - timedelta(minutes=29),
+                    ),
+                    PullRequestContainer(
+                        pull_request=PullRequest(id="id4", state="OPEN"),
+                        updated_at=datetime.utcnow() - timedelta(minutes=45),
+                    ),
+                ]
+            ),
+            ["id1", "id4"],
+        )
+
+
+def _pr_container(number: int, pull_request_id: str) -> PullRequestContainer:
+    return PullRequestContainer(
+        pull_request=PullRequest(
+            id=pull_request_id,
+            repository=Repository(name_with_owner="owner/name"),
+            number=number,
+        ),
+        updated_at=datetime.utcnow(),
+    )
+
+
+class TestPullRequestsMap(TestCase):
+    def test_init(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
 
-        self.patch_sleep = patch("intm.collectors.github_pull_requests._internal_sleep")
-        self.mock_sleep = self.patch_sleep.start()
+        self.assertSetEqual(pr_map.ids, {"id1"})
 
-    def tearDown(self) -> None:
-        self.patch_sleep.stop()
+    def test_setitem(self):
+        pr_map = PullRequestsMap()
 
-        super().tearDown()
+        pr_map["owner/name#1"] = _pr_container(1, "id1")
+        pr_map["owner/name#2"] = _pr_container(2, "id2")
+        pr_map["owner/name#1"] = _pr_container(1, "id3")
 
+        self.assertSetEqual(pr_map.ids, {"id2", "id3"})
+
+    def test_delitem(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        del pr_map["owner/name#1"]
+
+        self.assertSetEqual(pr_map.ids, set())
+
+    def test_pop(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        self.assertEqual(pr_map.pop("owner/name#1").pull_request.id, "id1")
+        self.assertIsNone(pr_map.pop("owner/name#1", None))
+        self.assertSetEqual(pr_map.ids, set())
+
+    def test_popitem(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        self.assertEqual(pr_map.popitem()[0], "owner/name#1")
+        self.assertSetEqual(pr_map.ids, set())
+
+    def test_clear(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        pr_map.clear()
+
+        self.assertSetEqual(pr_map.ids, set())
+
+    def test_setdefault(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        pr_map.setdefault("owner/name#1", _pr_container(1, "id3"))
+        pr_map.setdefault("owner/name#2", _pr_container(2, "id2"))
+
+        self.assertSetEqual(pr_map.ids, {"id1", "id2"})
+
+    def test_update(self):
+        pr_map = PullRequestsMap({"owner/name#1": _pr_container(1, "id1")})
+
+        pr_map.update({"owner/name#1": _pr_container(1, "id3")})
+        pr_map |= {"owner/name#2": _pr_container(2, "id2")}
+
+        self.assertIsInstance(pr_map, PullRequestsMap)
+        self.assertSetEqual(pr_map.ids, {"id2", "id3"})
+
+
+class TestGithubPullRequestCollector(TestCase):
     def test_run_empty_check_wait(self):
-        github = Mock(spec=Github)
+        github = StubGithub()
         collector = GithubPullRequestCollector(
             github,
         )
 
-        collector.stop()  # call stop before start to ensure only one execution
+        with patch.object(collector._stop_event, "wait", return_value=True) as mock_wait:
+            collector.start()
+
+            collector.join()
+
+        mock_wait.assert_called_once_with(60 * 5)
+
+    def test_stop_interrupts_wait(self):
+        github = StubGithub()
+        collector = GithubPullRequestCollector(
+            github,
+            wait_time=timedelta(hours=1),
+        )
+
         collector.start()
+        collector.stop()
 
-        collector.join()
+        collector.join(timeout=5)
 
-        self.mock_sleep.assert_called_with(60 * 5)
+        self.assertFalse(collector.is_alive())
 
     def test_one_query_single_call(self):
         """
@@ -244,10 +558,7 @@ class TestGithubPullRequestCollector(TestCase):
         """
         repo = Repository(name_with_owner="owner/name")
 
-        github = Mock(spec=Github)
-        github.search_pull_requests.side_effect = [
-            [],
-        ]
+        github = StubGithub(search_pull_requests=[[]])
 
         collector = GithubPullRequestCollector(
             github,
@@ -259,65 +570,78 @@ class TestGithubPullRequestCollector(TestCase):
 
         collector.join()
 
-        github.search_pull_requests.assert_called_once_with(
-            "query",
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [("query", PR_QUERY_DATA)],
         )
 
     def test_run_queries(self):
         with patch("intm.collectors.github_pull_requests.datetime") as mock_utc_now:
             mock_utc_now.utcnow.return_value = datetime(2010, 10, 8, 11, 43)
 
-            github = Mock(spec=Github)
+            repo = Repository(name_with_owner="owner/name")
+            github = StubGithub(
+                search_pull_requests=[
+                    [
+                        PullRequest(
+                            number=1, title="title1", id="id1", repository=repo
+                        ),
+                        PullRequest(
+                            number=2, title="title2", id="id2", repository=repo
+                        ),
+                    ],
+                    [
+                        PullRequest(
+                            number=3, title="title3", id="id3", repository=repo
+                        ),
+                        PullRequest(
+                            number=4, title="title4", id="id4", repository=repo
+                        ),
+                    ],
+                    [],
+                ],
+            )
             collector = GithubPullRequestCollector(
                 github,
                 queries=const_queries_from_list(["query1", "query2"]),
                 update_query=ConstantCollectQuery("update"),
             )
 
-            repo = Repository(name_with_owner="owner/name")
-            github.search_pull_requests.side_effect = [
-                [
-                    PullRequest(number=1, title="title1", id="id1", repository=repo),
-                    PullRequest(number=2, title="title2", id="id2", repository=repo),
-                ],
-                [
-                    PullRequest(number=3, title="title3", id="id3", repository=repo),
-                    PullRequest(number=4, title="title4", id="id4", repository=repo),
-                ],
-                [],
-            ]
-
             collector.stop()  # call stop before start to ensure only one execution
             collector.start()
 
             collector.join()
 
-            github.search_pull_requests.mock_calls[0] == call("query1", PR_QUERY_DATA)
-            github.search_pull_requests.mock_calls[1] == call("query2", PR_QUERY_DATA)
-            github.search_pull_requests.mock_calls[2] == call("update", PR_QUERY_DATA)
+            self.assertCountEqual(
+                github.search_pull_requests_calls,
+                [
+                    ("query1", PR_QUERY_DATA),
+                    ("query2", PR_QUERY_DATA),
+                    ("update", PR_QUERY_DATA),
+                ],
+            )
 
             for pull_request in collector.pull_requests_map.values():
                 self.assertEqual(pull_request.updated_at, datetime(2010, 10, 8, 11, 43))
 
     def test_need_update(self):
-        github = Mock(spec=Github)
-
         repo = Repository(name_with_owner="owner/name")
-        github.get_pull_requests_by_ids.side_effect = [
-            [
-                PullRequest(number=1, title="title1", id="id1", repository=repo),
-                PullRequest(number=4, title="title4", id="id4", repository=repo),
-                PullRequest(number=67, title="title67", id="id67", repository=repo),
+        github = StubGithub(
+            get_pull_requests_by_ids=[
+                [
+                    PullRequest(number=1, title="title1", id="id1", repository=repo),
+                    PullRequest(number=4, title="title4", id="id4", repository=repo),
+                    PullRequest(number=67, title="title67", id="id67", repository=repo),
+                ],
             ],
-        ]
-        github.search_pull_requests.side_effect = [
-            [
-                PullRequest(number=8, title="title8", id="id8", repository=repo),
-                PullRequest(number=9, title="title9", id="id9", repository=repo),
-                PullRequest(number=45, title="title45", id="id45", repository=repo),
+            search_pull_requests=[
+                [
+                    PullRequest(number=8, title="title8", id="id8", repository=repo),
+                    PullRequest(number=9, title="title9", id="id9", repository=repo),
+                    PullRequest(number=45, title="title45", id="id45", repository=repo),
+                ],
             ],
-        ]
+        )
 
         collector = GithubPullRequestCollector(
             github,
@@ -336,13 +660,13 @@ class TestGithubPullRequestCollector(TestCase):
 
         collector.join()
 
-        github.get_pull_requests_by_ids.assert_called_once_with(
-            ["id1", "id4", "id67"],
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.get_pull_requests_by_ids_calls,
+            [(["id1", "id4", "id67"], PR_QUERY_DATA)],
         )
-        github.search_pull_requests.assert_called_once_with(
-            "repo:owner/name is:pr 8 9 45",
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [("repo:owner/name is:pr 8 9 45", PR_QUERY_DATA)],
         )
 
     def test_generate_new_updates_due_to_dependencies(self):
@@ -358,20 +682,21 @@ class TestGithubPullRequestCollector(TestCase):
         """
         repo = Repository(name_with_owner="owner/name")
 
-        github = Mock(spec=Github)
-        github.get_pull_requests_by_ids.side_effect = [
-            [
-                PullRequest(number=2, id="id2", repository=repo),
-            ],
-        ]
-        github.search_pull_requests.side_effect = [
-            [
-                PullRequest(number=0, id="id0", repository=repo),
+        github = StubGithub(
+            get_pull_requests_by_ids=[
+                [
+                    PullRequest(number=2, id="id2", repository=repo),
+                ],
             ],
-            [
-                PullRequest(number=4, id="id4", repository=repo),
+            search_pull_requests=[
+                [
+                    PullRequest(number=0, id="id0", repository=repo),
+                ],
+                [
+                    PullRequest(number=4, id="id4", repository=repo),
+                ],
             ],
-        ]
+        )
 
         dependency_mock = Mock()
         dependency_mock.side_effect = [
@@ -405,13 +730,16 @@ class TestGithubPullRequestCollector(TestCase):
 
         collector.join()
 
-        github.search_pull_requests.mock_calls[0] == call("query", PR_QUERY_DATA)
-        github.search_pull_requests.mock_calls[1] == call(
-            "repo:owner/name is:pr 4", PR_QUERY_DATA
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [
+                ("query", PR_QUERY_DATA),
+                ("repo:owner/name is:pr 4", PR_QUERY_DATA),
+            ],
         )
-        github.get_pull_requests_by_ids.assert_called_once_with(
-            ["id2"],
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.get_pull_requests_by_ids_calls,
+            [(["id2"], PR_QUERY_DATA)],
         )
 
     def test_calculate_pull_request_needs_update(self):
@@ -425,13 +753,14 @@ class TestGithubPullRequestCollector(TestCase):
         pr_two = PullRequest(id="id2", repository=repo, number=2)
         pr_three = PullRequest(id="id3", repository=repo, number=3)
 
-        github = Mock(spec=Github)
-        github.get_pull_requests_by_ids.side_effect = [
-            [
-                pr_one,
-                pr_two,
+        github = StubGithub(
+            get_pull_requests_by_ids=[
+                [
+                    pr_one,
+                    pr_two,
+                ],
             ],
-        ]
+        )
 
         callback_need_update_one = Mock()
         callback_need_update_one.side_effect = [
@@ -474,9 +803,9 @@ class TestGithubPullRequestCollector(TestCase):
 
         collector.join()
 
-        github.get_pull_requests_by_ids.assert_called_once_with(
-            ["id1", "id2"],
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.get_pull_requests_by_ids_calls,
+            [(["id1", "id2"], PR_QUERY_DATA)],
         )
 
     def test_required_status_check(self):
@@ -511,14 +840,15 @@ class TestGithubPullRequestCollector(TestCase):
             ),
         )
 
-        github = Mock(spec=Github)
-        github.search_pull_requests.side_effect = [
-            [
-                pr_one,
-                pr_two,
-                pr_three,
+        github = StubGithub(
+            search_pull_requests=[
+                [
+                    pr_one,
+                    pr_two,
+                    pr_three,
+                ],
             ],
-        ]
+        )
 
         required_status_checks = Mock()
         required_status_checks.side_effect = [
@@ -570,7 +900,446 @@ class TestGithubPullRequestCollector(TestCase):
             ],
         )
 
-        github.search_pull_requests.assert_called_once_with(
-            "query",
-            PR_QUERY_DATA,
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [("query", PR_QUERY_DATA)],
+        )
+
+    def test_refetch_rebuilds_container(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        collector = GithubPullRequestCollector(StubGithub())
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1, title="title")]
+        )
+        pr_container = collector.pull_requests_map["owner/name#1"]
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1, title="new title")]
+        )
+
+        self.assertIsNot(collector.pull_requests_map["owner/name#1"], pr_container)
+        self.assertEqual(
+            collector.pull_requests_map["owner/name#1"].pull_request.title,
+            "new title",
+        )
+
+    def test_refetch_replaces_assigned_container(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        collector = GithubPullRequestCollector(StubGithub())
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1, title="fresh")]
+        )
+
+        collector.pull_requests_map = {
+            "owner/name#1": PullRequestContainer(
+                pull_request=PullRequest(
+                    id="id1", repository=repo, number=1, title="stale"
+                ),
+                updated_at=datetime.utcnow(),
+            ),
+        }
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1, title="fresh")]
+        )
+
+        self.assertEqual(
+            collector.pull_requests_map["owner/name#1"].pull_request.title,
+            "fresh",
+        )
+
+    def test_known_ids_follow_updates(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        collector = GithubPullRequestCollector(StubGithub())
+        collector.pull_requests_map = {
+            "owner/name#1": PullRequestContainer(
+                pull_request=PullRequest(id="id1", repository=repo, number=1),
+                updated_at=datetime.utcnow(),
+            ),
+        }
+
+        collector._update_pull_requests(
+            [PullRequest(id="id2", repository=repo, number=2)]
+        )
+
+        self.assertSetEqual(collector.pull_requests_map.ids, {"id1", "id2"})
+
+    def test_deleted_pull_request_queued_as_dependency(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        dependency_mock = Mock()
+        dependency_mock.side_effect = [([], []), (["id1"], [])]
+
+        collector = GithubPullRequestCollector(
+            StubGithub(),
+            dependencies_callback=dependency_mock,
+        )
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1)]
+        )
+
+        del collector.pull_requests_map["owner/name#1"]
+
+        collector._update_pull_requests(
+            [PullRequest(id="id2", repository=repo, number=2)]
+        )
+
+        self.assertSetEqual(collector.pull_requests_needing_update_ids, {"id1"})
+
+    def test_need_update_multiple_repositories(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(github)
+
+        for number in range(1, 52):
+            collector.pull_requests_needing_update_uris.add(f"owner/one#{number}")
+        collector.pull_requests_needing_update_uris.add("owner/two#3")
+
+        collector.stop()  # call stop before start to ensure only one execution
+        collector.start()
+
+        collector.join()
+
+        self.assertCountEqual(
+            github.search_pull_requests_calls,
+            [
+                (
+                    "repo:owner/one is:pr " + " ".join(map(str, range(1, 51))),
+                    PR_QUERY_DATA,
+                ),
+                ("repo:owner/one is:pr 51", PR_QUERY_DATA),
+                ("repo:owner/two is:pr 3", PR_QUERY_DATA),
+            ],
+        )
+
+    def test_need_update_ids_paged(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(github)
+
+        for number in range(100, 160):
+            collector.pull_requests_needing_update_ids.add(f"id{number}")
+
+        collector.stop()  # call stop before start to ensure only one execution
+        collector.start()
+
+        collector.join()
+
+        self.assertCountEqual(
+            github.get_pull_requests_by_ids_calls,
+            [
+                ([f"id{number}" for number in range(100, 150)], PR_QUERY_DATA),
+                ([f"id{number}" for number in range(150, 160)], PR_QUERY_DATA),
+            ],
+        )
+
+    def test_batch_shares_updated_at(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        collector = GithubPullRequestCollector(StubGithub())
+
+        collector._update_pull_requests(
+            [
+                PullRequest(id="id1", repository=repo, number=1),
+                PullRequest(id="id2", repository=repo, number=2),
+            ]
+        )
+
+        self.assertEqual(
+            collector.pull_requests_map["owner/name#1"].updated_at,
+            collector.pull_requests_map["owner/name#2"].updated_at,
+        )
+
+    def test_uris_are_interned(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        dependency_mock = Mock()
+        dependency_mock.return_value = ([], ["owner/name#" + str(2)])
+
+        collector = GithubPullRequestCollector(
+            StubGithub(),
+            dependencies_callback=dependency_mock,
+        )
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1)]
+        )
+
+        uri = next(iter(collector.pull_requests_map))
+        self.assertIs(uri, sys.intern("owner/name#1"))
+        self.assertIs(
+            collector.pull_requests_map[uri].dependencies[0],
+            sys.intern("owner/name#2"),
+        )
+
+    def test_no_dependencies_share_empty_tuple(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        collector = GithubPullRequestCollector(StubGithub())
+
+        collector._update_pull_requests(
+            [PullRequest(id="id1", repository=repo, number=1)]
         )
+
+        self.assertIs(collector.pull_requests_map["owner/name#1"].dependencies, ())
+
+    def test_update_from_generator(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        dependency_mock = Mock()
+        dependency_mock.side_effect = [
+            (["id2"], ["owner/name#2"]),
+            ([], []),
+        ]
+
+        collector = GithubPullRequestCollector(
+            StubGithub(),
+            dependencies_callback=dependency_mock,
+        )
+
+        collector._update_pull_requests(
+            pull_request
+            for pull_request in [
+                PullRequest(id="id1", repository=repo, number=1),
+                PullRequest(id="id2", repository=repo, number=2),
+            ]
+        )
+
+        self.assertListEqual(
+            sorted(collector.pull_requests_map), ["owner/name#1", "owner/name#2"]
+        )
+        self.assertSetEqual(collector.pull_requests_needing_update_ids, set())
+        self.assertSetEqual(collector.pull_requests_needing_update_uris, set())
+
+    def test_rate_limits(self):
+        github = StubGithub()
+
+        search_rate_limit = Mock(spec=TokenBucket)
+        core_rate_limit = Mock(spec=TokenBucket)
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query1", "query2"]),
+            search_rate_limit=search_rate_limit,
+            core_rate_limit=core_rate_limit,
+        )
+        collector.pull_requests_needing_update_ids.add("id1")
+
+        collector.stop()  # call stop before start to ensure only one execution
+        collector.start()
+
+        collector.join()
+
+        self.assertEqual(search_rate_limit.acquire.call_count, 2)
+        self.assertEqual(core_rate_limit.acquire.call_count, 1)
+
+    def test_need_update_batch_callbacks(self):
+        repo = Repository(name_with_owner="owner/name")
+
+        github = StubGithub(
+            search_pull_requests=[
+                [
+                    PullRequest(number=1, id="id1", repository=repo),
+                    PullRequest(number=2, id="id2", repository=repo),
+                ],
+            ],
+        )
+
+        batch_callback = Mock(return_value=["id2"])
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query"]),
+            need_update_batch_callbacks=[batch_callback],
+        )
+
+        collector.stop()  # call stop before start to ensure only one execution
+        collector.start()
+
+        collector.join()
+
+        batch_callback.assert_called_once()
+        self.assertListEqual(
+            [
+                pr_container.pull_request.id
+                for pr_container in batch_callback.call_args_list[0][0][0]
+            ],
+            ["id1", "id2"],
+        )
+        self.assertListEqual(
+            github.get_pull_requests_by_ids_calls,
+            [(["id2"], PR_QUERY_DATA)],
+        )
+
+    def test_stop_ends_rate_limit_wait(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query1", "query2"]),
+            search_rate_limit=TokenBucket(rate=0.001, burst=1),
+            core_rate_limit=TokenBucket(rate=0.001, burst=1),
+            max_workers=1,
+        )
+        for number in range(60):
+            collector.pull_requests_needing_update_ids.add(f"id{number}")
+
+        collector.start()
+        collector.stop()
+
+        collector.join(timeout=5)
+
+        self.assertFalse(collector.is_alive())
+        self.assertLessEqual(len(github.search_pull_requests_calls), 1)
+        self.assertLessEqual(len(github.get_pull_requests_by_ids_calls), 1)
+
+    def test_executor_shut_down_on_error(self):
+        github = Mock(spec=Github)
+        github.search_pull_requests.side_effect = RuntimeError("search failed")
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query"]),
+        )
+
+        with patch.object(
+            collector._executor, "shutdown", wraps=collector._executor.shutdown
+        ) as mock_shutdown:
+            with self.assertRaises(RuntimeError):
+                collector._run()
+
+        mock_shutdown.assert_called_once_with()
+
+    def test_default_rate_limits(self):
+        collector = GithubPullRequestCollector(StubGithub())
+
+        self.assertEqual(collector.search_rate_limit.rate, 0.5)
+        self.assertEqual(collector.core_rate_limit.burst, 50)
+
+    def test_need_update_requests_run_concurrently(self):
+        searched = Event()
+        searched_while_fetching_ids = []
+
+        def get_pull_requests_by_ids(*_):
+            searched_while_fetching_ids.append(searched.wait(timeout=5))
+            return []
+
+        def search_pull_requests(*_):
+            searched.set()
+            return []
+
+        github = Mock(spec=Github)
+        github.get_pull_requests_by_ids.side_effect = get_pull_requests_by_ids
+        github.search_pull_requests.side_effect = search_pull_requests
+
+        collector = GithubPullRequestCollector(github)
+        collector.pull_requests_needing_update_ids.add("id1")
+        collector.pull_requests_needing_update_uris.add("owner/name#1")
+
+        collector.stop()  # call stop before start to ensure only one execution
+        collector.start()
+
+        collector.join()
+
+        self.assertListEqual(searched_while_fetching_ids, [True])
+        github.get_pull_requests_by_ids.assert_called_once_with(["id1"], PR_QUERY_DATA)
+
+    def test_rate_limit_reset_wait(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query"]),
+            rate_limit_reset_callback=lambda: datetime.utcnow()
+            + timedelta(minutes=10),
+        )
+
+        with patch.object(
+            collector._stop_event, "wait", side_effect=[False, True]
+        ) as mock_wait:
+            collector.start()
+
+            collector.join()
+
+        self.assertAlmostEqual(mock_wait.call_args_list[0][0][0], 600, delta=5)
+        mock_wait.assert_called_with(60 * 5)
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [("query", PR_QUERY_DATA)],
+        )
+
+    def test_rate_limit_reset_in_past(self):
+        collector = GithubPullRequestCollector(
+            StubGithub(),
+            rate_limit_reset_callback=lambda: datetime.utcnow()
+            - timedelta(minutes=10),
+        )
+
+        with patch.object(
+            collector._stop_event, "wait", side_effect=[False, True]
+        ) as mock_wait:
+            collector.start()
+
+            collector.join()
+
+        self.assertEqual(mock_wait.call_args_list[0][0][0], 0.0)
+
+    def test_rate_limit_reset_timezone_aware(self):
+        reset_at = datetime.now(timezone(timedelta(hours=2))) + timedelta(minutes=10)
+
+        collector = GithubPullRequestCollector(
+            StubGithub(),
+            rate_limit_reset_callback=lambda: reset_at,
+        )
+
+        with patch.object(
+            collector._stop_event, "wait", side_effect=[False, True]
+        ) as mock_wait:
+            collector.start()
+
+            collector.join()
+
+        self.assertAlmostEqual(mock_wait.call_args_list[0][0][0], 600, delta=5)
+
+    def test_rate_limit_not_low(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query"]),
+            rate_limit_reset_callback=lambda: None,
+        )
+
+        with patch.object(collector._stop_event, "wait", return_value=True) as mock_wait:
+            collector.start()
+
+            collector.join()
+
+        mock_wait.assert_called_once_with(60 * 5)
+        self.assertListEqual(
+            github.search_pull_requests_calls,
+            [("query", PR_QUERY_DATA)],
+        )
+
+    def test_stopped_while_waiting_for_rate_limit_reset(self):
+        github = StubGithub()
+
+        collector = GithubPullRequestCollector(
+            github,
+            queries=const_queries_from_list(["query"]),
+            rate_limit_reset_callback=lambda: datetime.utcnow()
+            + timedelta(minutes=10),
+        )
+
+        collector.stop()  # call stop before start, the reset wait returns at once
+        collector.start()
+
+        collector.join()
+
+        self.assertListEqual(github.search_pull_requests_calls, [])
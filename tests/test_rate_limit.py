@@ -0,0 +1,98 @@
+from unittest import TestCase
+from unittest.mock import patch, Mock
+from threading import Event
+
+from intm.rate_limit import TokenBucket
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.patch_time = patch("intm.rate_limit.time")
+        self.mock_time = self.patch_time.start()
+        self.mock_time.monotonic.return_value = 0.0
+
+    def tearDown(self) -> None:
+        self.patch_time.stop()
+
+        super().tearDown()
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1.0, burst=3)
+
+        for _ in range(3):
+            bucket.acquire()
+
+        self.mock_time.sleep.assert_not_called()
+
+    def test_wait_for_token(self):
+        bucket = TokenBucket(rate=2.0, burst=1)
+
+        bucket.acquire()
+
+        self.mock_time.sleep.side_effect = lambda _: setattr(
+            self.mock_time.monotonic, "return_value", 0.5
+        )
+        bucket.acquire()
+
+        self.mock_time.sleep.assert_called_once_with(0.5)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=1.0, burst=2)
+
+        bucket.acquire()
+        bucket.acquire()
+
+        self.mock_time.monotonic.return_value = 1.0
+        bucket.acquire()
+
+        self.mock_time.sleep.assert_not_called()
+
+    def test_refill_limited_by_burst(self):
+        bucket = TokenBucket(rate=1.0, burst=2)
+
+        self.mock_time.monotonic.return_value = 100.0
+        for _ in range(2):
+            bucket.acquire()
+
+        self.mock_time.sleep.side_effect = lambda _: setattr(
+            self.mock_time.monotonic, "return_value", 101.0
+        )
+        bucket.acquire()
+
+        self.mock_time.sleep.assert_called_once_with(1.0)
+
+    def test_wait_for_token_with_stop_event(self):
+        bucket = TokenBucket(rate=2.0, burst=1)
+        stop_event = Mock(spec=Event)
+        stop_event.wait.return_value = False
+
+        bucket.acquire()
+
+        self.mock_time.monotonic.return_value = 0.5
+        self.assertTrue(bucket.acquire(stop_event))
+
+        self.mock_time.sleep.assert_not_called()
+
+        self.mock_time.monotonic.return_value = 0.75
+        self.assertTrue(bucket.acquire(stop_event))
+
+        stop_event.wait.assert_called_once_with(0.25)
+        self.mock_time.sleep.assert_not_called()
+
+    def test_stop_event_interrupts_wait(self):
+        bucket = TokenBucket(rate=1.0, burst=1)
+        stop_event = Event()
+
+        bucket.acquire()
+
+        stop_event.set()
+        self.assertFalse(bucket.acquire(stop_event))
+
+        self.mock_time.sleep.assert_not_called()
+
+        # The interrupted wait did not take a token
+        self.mock_time.monotonic.return_value = 1.0
+        self.assertTrue(bucket.acquire())
+        self.mock_time.sleep.assert_not_called()